@@ -1,94 +1,200 @@
+import functools
+import hashlib
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from pyarrow import csv as pacsv
 import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 plt.style.use('seaborn')
 
+# =============================================================================
+# caching helpers
+# =============================================================================
+# bump to invalidate cached results when their layout changes for reasons the
+# script source does not capture (e.g. a library upgrade)
+CACHE_VERSION = 1
+
+
+def cache_on_inputs(*paths, cache_dir = './cache'):
+    '''cache a dataframe-returning function as a feather file keyed on the
+    modified time and size of its input files plus this script's source, so
+    unchanged inputs and code load the previous result instead of recomputing
+    it'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper():
+            key = hashlib.blake2b(f'{func.__name__}:{CACHE_VERSION}'.encode(),
+                                  digest_size = 16)
+            with open(__file__, 'rb') as src:
+                key.update(src.read())
+            for path in paths:
+                key.update(f'{path}:{os.path.getmtime(path)}:'
+                           f'{os.path.getsize(path)}'.encode())
+            cache_path = os.path.join(cache_dir, f'{key.hexdigest()}.arrow')
+            if os.path.exists(cache_path):
+                return feather.read_feather(cache_path)
+            df = func()
+            
+            # write to a temp file and move it into place so an interrupted
+            # write never leaves a partial cache file behind
+            os.makedirs(cache_dir, exist_ok = True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            feather.write_feather(df, tmp_path)
+            os.replace(tmp_path, cache_path)
+            return df
+        return wrapper
+    return decorator
+
+
 # =============================================================================
 # analysis / transformation functions
 # =============================================================================
+def csv_to_parquet(csv_path, parquet_path, column_names = None,
+                   column_types = None):
+    '''convert a raw csv to a parquet copy once so later runs skip the text
+    parsing - the copy is rebuilt whenever the csv is newer than it or was
+    written with different parsing options. parsing uses the multi-threaded
+    arrow reader and writes the arrow table as-is'''
+    # read empty / NA style strings as nulls, matching pd.read_csv
+    convert_kwargs = {'column_types':column_types,
+                      'strings_can_be_null':True}
+    
+    # tag the copy with a hash of the options used to build it, so changing
+    # the column names or types rebuilds it instead of reusing stale types
+    opts = repr((column_names,
+                 sorted((k, str(v)) for k, v in convert_kwargs.items())))
+    tag = hashlib.blake2b(opts.encode(), digest_size = 16).hexdigest()
+    
+    if (not os.path.exists(parquet_path) or
+            os.path.getmtime(parquet_path) < os.path.getmtime(csv_path) or
+            (pq.read_schema(parquet_path).metadata or {}).get(
+                    b'csv_options') != tag.encode()):
+        tbl = pacsv.read_csv(
+                csv_path,
+                read_options = pacsv.ReadOptions(column_names = column_names),
+                convert_options = pacsv.ConvertOptions(**convert_kwargs))
+        tbl = tbl.replace_schema_metadata({'csv_options':tag})
+        
+        # write to a temp file and move it into place so an interrupted
+        # write never leaves a partial parquet copy behind
+        tmp_path = f'{parquet_path}.{os.getpid()}.tmp'
+        pq.write_table(tbl, tmp_path, compression = 'zstd')
+        os.replace(tmp_path, parquet_path)
+    return parquet_path
+
+
 def read_data():
     '''form the base dataframe by importing and joining the two data sets'''
-    # bring in activity data
-    act = pd.read_csv('./team_activity.csv', header = None)
-    act.columns = ['ds', 'team_id', 'country', 'industry_id', 'active_users',
-                   'messages_7d']
+    # bring in activity data, keeping ds as a true date column so later
+    # filters compare dates instead of strings
+    act = pq.read_table(csv_to_parquet(
+            './team_activity.csv', './team_activity.parquet',
+            column_names = ['ds', 'team_id', 'country', 'industry_id',
+                            'active_users', 'messages_7d'],
+            column_types = {'ds':pa.date32(),
+                            'industry_id':pa.int64(),
+                            'active_users':pa.int64(),
+                            'messages_7d':pa.int64()})
+            ).to_pandas(date_as_object = False)
     
     # bring in industry data map
-    ind = pd.read_csv('./industry_map.csv')
+    ind = pd.read_parquet(csv_to_parquet('./industry_map.csv',
+                                         './industry_map.parquet'))
     
     # conform the duplicate healthcare industries to same name
-    ind['industry'] = ind['industry'].str.replace('Health Care', 'Healthcare')
-    
-    # merge the industry data with activity data, prioritizing activity data 
-    df = pd.merge(act, ind,
-                  how = 'left',
-                  on = 'industry_id')
+    lut = ind.set_index('industry_id')['industry'].str.replace('Health Care',
+                                                               'Healthcare')
+    
+    # look up the industry name for each activity row - the map only adds
+    # one column, so an indexed lookup is cheaper than a full merge
+    act['industry'] = act['industry_id'].map(lut)
+    
+    # key columns repeat heavily, so store them as categoricals for cheaper
+    # groupbys and membership checks
+    df = act.astype({'team_id':'category',
+                    'country':'category',
+                    'industry':'category'})
     return df    
     
 
-def check_no_active_users(df):
+def team_stats(df):
+    '''summarize active users per team in a single groupby pass - feeds both
+    of the team level checks below'''
+    return df.groupby(['team_id'], observed = True, sort = False).agg(
+            max = ('active_users', 'max'),
+            n = ('active_users', 'count'))
+
+
+def check_no_active_users(stats):
     '''filter out teams that had no active users for entire analysis period'''
-    dau_check = df.groupby(['team_id'])['active_users'].agg(
-        ['min', 'max'])
-    dau_check['filter'] = dau_check['max'] + dau_check['max']
-    inactive_teams = dau_check[dau_check['filter'] == 0]
-    return [t for t in inactive_teams.index]
+    inactive_teams = stats[stats['max'] == 0]
+    return inactive_teams.index
 
     
-def check_consistent_cohort(df):
+def check_consistent_cohort(stats):
     '''only analyze teams present all days of the analysis period'''
-    cohort_chk = df.groupby(['team_id'])['active_users'].count()
+    cohort_chk = stats['n']
     cohort_chk = cohort_chk[cohort_chk != max(cohort_chk)]
-    return [t for t in cohort_chk.index]
+    return cohort_chk.index
+
+
+@cache_on_inputs('./team_activity.csv', './industry_map.csv')
+def load_clean_data():
+    '''read the base dataframe and clean up teams that had no active users for
+    the entire period and teams that were not present in the cohort for
+    entire period'''
+    df = read_data()
+    stats = team_stats(df)
+    inactive_idx = check_no_active_users(stats)
+    cohort_idx = check_consistent_cohort(stats)
+    df = df.loc[~df['team_id'].isin(inactive_idx.union(cohort_idx))]
+    return df.reset_index(drop = True)
 
 
 def check_missing_dates(df):
     '''check full date range against a unique set of dates present
     in the dataframe to make sure we are not missing any days - we are
     missing one: 3/13/2020'''
-    dates = set(pd.to_datetime(df['ds']))
-    dt_rng = pd.date_range(start = min(dates), end = max(dates), freq = 'd')
-    missing_dts = [d for d in dt_rng if d not in dates]
+    dates = pd.unique(df['ds'].values.astype('datetime64[D]'))
+    dt_rng = np.arange(dates.min(), dates.max() + 1)
+    missing_dts = np.setdiff1d(dt_rng, dates, assume_unique = True).tolist()
     return missing_dts
 
 
-def active_users_by_ind(df):
-    '''find industries with the most active users at the end of July 2020.
+def active_users_by_ind(end_jul_df):
+    '''find industries with the most active users at the end of July 2020,
+    given data already filtered to the last week of the analysis.
     Addresses question #1'''
-    # filter data to the last week of the analysis and then groupby/sum by ind
-    end_jul_df = df[df['ds'] >= '2020-07-25']
-    ind_users = end_jul_df.groupby(['industry'])['active_users'].sum(
-            ).reset_index()
+    # groupby/sum by ind over the last week of the analysis
+    ind_users = end_jul_df.groupby(['industry'], observed = True,
+                                   sort = False)[
+            'active_users'].sum().reset_index()
     # compute a daily average using the 7 day sums by industry
     ind_users['avg_daily_users'] =  ind_users['active_users'] / 7
     ind_users.sort_values('active_users', ascending = False, inplace = True)
     return ind_users
 
 
-def avg_team_sz_top_countries(df, top_n):
+def avg_team_sz_top_countries(cntry_df, top_n):
     '''find the top countries by active users, and then compute the average
-    team size in those countries using last month of user data as proxy.
-    Addresses question #2'''
-    # use last month of data to get a more stable team size measure
-    cntry_df = df[df['ds'] >= '2020-07-01']
-    
+    team size in those countries using last month of user data as proxy,
+    given data already filtered to that month. Addresses question #2'''
     # get distinct count of teams and total users by country
-    cntry_summ = cntry_df.groupby(['country']).agg({'team_id':'nunique',
-                    'active_users':'mean'}).reset_index()
+    cntry_summ = cntry_df.groupby(['country'], observed = True).agg(
+            {'team_id':'nunique',
+             'active_users':'mean'}).reset_index()
     
     # rename columns to accurately reflect metrics computed
     cntry_summ.columns = ['country', 'countd_teams', 'avg_team_sz']
     
-    # retrieve only top 5 countries and sort descending
-    cntry_summ['teams_cnt_rank'] = cntry_summ['countd_teams'].rank(
-            ascending = False)
-    cntry_summ.sort_values('teams_cnt_rank', inplace = True)
-    
-    # filter to top n countries
-    cntry_summ = cntry_summ[cntry_summ['teams_cnt_rank'] <= top_n]
-    
-    # sort by average team size for charting
-    cntry_summ.sort_values('avg_team_sz', ascending = False, inplace = True)
+    # filter to top n countries, then sort by average team size for charting
+    cntry_summ = cntry_summ.nlargest(top_n, 'countd_teams').sort_values(
+            'avg_team_sz', ascending = False)
     return cntry_summ
     
 
@@ -98,16 +204,19 @@ def daily_summary_figues(df):
     size. Addresses question #3'''
     
     # get distinct count of teams and total users by country
-    dly_summ = df.groupby(['ds']).agg(
+    dly_summ = df.groupby(['ds'], observed = True).agg(
         {'team_id':'nunique',
         'active_users':['sum', 'mean'],
-        'messages_7d':lambda x:sum(x)/1e6
+        'messages_7d':'sum'
         })
     
     # rename columns to reflect metrics computed
     dly_summ.columns = ['countd_teams', 'total_active_users', 'avg_team_users',
                         'total_msgs_mm']
     
+    # scale total messages to millions
+    dly_summ['total_msgs_mm'] = dly_summ['total_msgs_mm']/1e6
+    
     # compute messages per user
     dly_summ['msgs_per_user'] = dly_summ[
             'total_msgs_mm']*1e6/dly_summ['total_active_users']
@@ -118,11 +227,12 @@ def daily_summary_figues(df):
 # =============================================================================
 # charting functions
 # =============================================================================
-def chart_top_industries(df):
-    fig, ax = plt.subplots(figsize = (8, 5),
-                           sharey = True,
-                           sharex = True)
-    
+# shared y axis formatters - thousands separators for counts and for decimals
+INT_FMT = matplotlib.ticker.FuncFormatter(lambda x, p: format(int(x), ','))
+FLOAT_FMT = matplotlib.ticker.FuncFormatter(lambda x, p: format(x, ','))
+
+
+def chart_top_industries(df, ax):
     df.plot(kind = 'bar', x = 'industry', y = 'avg_daily_users', width = .85,
             ax = ax)
     
@@ -133,20 +243,13 @@ def chart_top_industries(df):
     ax.legend().set_visible(False)
     
     # y axis format
-    ax.get_yaxis().set_major_formatter(matplotlib.ticker.FuncFormatter(
-            lambda x, p: format(int(x), ',')))
+    ax.get_yaxis().set_major_formatter(INT_FMT)
     
     # font sizes
     ax.title.set_size(14)
-    
-    plt.show()
 
 
-def chart_daily_team_cnt(df):
-    fig, ax = plt.subplots(figsize = (8, 5),
-                           sharey = True,
-                           sharex = True)
-    
+def chart_daily_team_cnt(df, ax):
     df.plot(kind = 'line', x = 'ds', y = 'countd_teams', ax = ax)
     
     # set titles
@@ -159,17 +262,10 @@ def chart_daily_team_cnt(df):
     ax.title.set_size(14)
     
     # y axis format
-    ax.get_yaxis().set_major_formatter(matplotlib.ticker.FuncFormatter(
-            lambda x, p: format(int(x), ',')))
+    ax.get_yaxis().set_major_formatter(INT_FMT)
     
-    plt.show()
-    
-    
-def chart_daily_active_users(df):
-    fig, ax = plt.subplots(figsize = (8, 5),
-                           sharey = True,
-                           sharex = True)
     
+def chart_daily_active_users(df, ax):
     df.plot(kind = 'line', x = 'ds', y = 'total_active_users', ax = ax)
     
     # set titles
@@ -179,20 +275,13 @@ def chart_daily_active_users(df):
     ax.legend().set_visible(False)
     
     # y axis format
-    ax.get_yaxis().set_major_formatter(matplotlib.ticker.FuncFormatter(
-            lambda x, p: format(int(x), ',')))
+    ax.get_yaxis().set_major_formatter(INT_FMT)
     
     # font sizes
     ax.title.set_size(14)
     
-    plt.show()
-    
 
-def chart_avg_team_size(df):
-    fig, ax = plt.subplots(figsize = (8, 5),
-                           sharey = True,
-                           sharex = True)
-    
+def chart_avg_team_size(df, ax):
     df.plot(kind = 'line', x = 'ds', y = 'avg_team_users', ax = ax)
     
     # set titles
@@ -202,20 +291,13 @@ def chart_avg_team_size(df):
     ax.legend().set_visible(False)
     
     # y axis format
-    ax.get_yaxis().set_major_formatter(matplotlib.ticker.FuncFormatter(
-            lambda x, p: format(int(x), ',')))
+    ax.get_yaxis().set_major_formatter(INT_FMT)
     
     # font sizes
     ax.title.set_size(14)
     
-    plt.show()
-    
-    
-def chart_msgs_sent(df):
-    fig, ax = plt.subplots(figsize = (8, 5),
-                           sharey = True,
-                           sharex = True)
     
+def chart_msgs_sent(df, ax):
     df.plot(kind = 'line', x = 'ds', y = 'total_msgs_mm', ax = ax)
     
     # set titles
@@ -225,20 +307,13 @@ def chart_msgs_sent(df):
     ax.legend().set_visible(False)
     
     # y axis format
-    ax.get_yaxis().set_major_formatter(matplotlib.ticker.FuncFormatter(
-            lambda x, p: format(x, ',')))
+    ax.get_yaxis().set_major_formatter(FLOAT_FMT)
     
     # font sizes
     ax.title.set_size(14)
     
-    plt.show()
-    
-    
-def chart_top_cntry_team_sz(df):
-    fig, ax = plt.subplots(figsize = (8, 5),
-                           sharey = True,
-                           sharex = True)
     
+def chart_top_cntry_team_sz(df, ax):
     df.plot(kind = 'bar', x = 'country', y = 'avg_team_sz', width = .85,
             ax = ax)
     
@@ -249,13 +324,10 @@ def chart_top_cntry_team_sz(df):
     ax.legend().set_visible(False)
     
     # y axis format
-    ax.get_yaxis().set_major_formatter(matplotlib.ticker.FuncFormatter(
-            lambda x, p: format(x, ',')))
+    ax.get_yaxis().set_major_formatter(FLOAT_FMT)
     
     # font sizes
     ax.title.set_size(14)
-    
-    plt.show()
       
 
 # =============================================================================
@@ -263,30 +335,35 @@ def chart_top_cntry_team_sz(df):
 # =============================================================================
 if __name__ == '__main__':
     
-    # read and transform data for charting
-    df = read_data()
-    
-    # clean up teams that had no active users for the entire period
-    inactive_list = check_no_active_users(df)
-    df = df[~df['team_id'].isin(inactive_list)]
-    
-    # clean up teams that were not present in the cohort for entire period
-    cohort_chk = check_consistent_cohort(df)
-    df = df[~df['team_id'].isin(cohort_chk)]
+    # read and clean data for charting, reusing the cached copy when the
+    # input files have not changed
+    df = load_clean_data()
     
     # find missing dates
     missing_dts = check_missing_dates(df)
     
+    # slice July once - the last month gives a more stable team size measure
+    # and the last week of it is used for the industry view
+    jul_df = df.loc[df['ds'] >= np.datetime64('2020-07-01')]
+    end_jul_df = jul_df.loc[jul_df['ds'] >= np.datetime64('2020-07-25')]
+    
     # find answers to questions in README
-    ind_users = active_users_by_ind(df)
-    cntry_summ = avg_team_sz_top_countries(df, top_n = 5)
+    ind_users = active_users_by_ind(end_jul_df)
+    cntry_summ = avg_team_sz_top_countries(jul_df, top_n = 5)
     dly_summ = daily_summary_figues(df)
     
-    # chart data for presentation/exploration
-    chart_top_industries(ind_users)
-    chart_top_cntry_team_sz(cntry_summ)
-    chart_daily_team_cnt(dly_summ)
-    chart_daily_active_users(dly_summ)
-    chart_msgs_sent(dly_summ)
-    chart_avg_team_size(dly_summ)
+    # chart data for presentation/exploration on a single 3x2 figure
+    fig, axes = plt.subplots(3, 2, figsize = (16, 12))
+    chart_top_industries(ind_users, axes[0, 0])
+    chart_top_cntry_team_sz(cntry_summ, axes[0, 1])
+    chart_daily_team_cnt(dly_summ, axes[1, 0])
+    chart_daily_active_users(dly_summ, axes[1, 1])
+    chart_msgs_sent(dly_summ, axes[2, 0])
+    chart_avg_team_size(dly_summ, axes[2, 1])
+    fig.tight_layout()
+    
+    # render headless and write the charts to disk
+    os.makedirs('./out', exist_ok = True)
+    fig.savefig('./out/summary_charts.png', dpi = 100, bbox_inches = 'tight')
+    plt.close(fig)
 